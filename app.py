@@ -1,11 +1,14 @@
 import io
+import json
+import threading
 import zipfile
 from datetime import datetime
 
 import pandas as pd
 import streamlit as st
 from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
 from openpyxl.styles import Font, Alignment, numbers
 
 st.set_page_config(page_title="Weekly Company Report Calculator", layout="wide")
@@ -38,122 +41,298 @@ PREPOP_TECHS = [
     {"name": "Clyde Owen",      "rate_pct": 25.0, "truck": False, "meter": False},
 ]
 
+# ---------- Shared cell styles ----------
+BOLD = Font(bold=True)
+RIGHT = Alignment(horizontal="right")
+HDR_ALIGN = Alignment(vertical="center")
+
 # ---------- State & helpers ----------
 def init_state():
     if "employees" not in st.session_state:
         st.session_state.employees = [dict(x) for x in PREPOP_TECHS]
+    if "employees_by_name" not in st.session_state:
+        # Same dicts as in `employees`, indexed for O(1) lookups
+        st.session_state.employees_by_name = {e["name"]: e for e in st.session_state.employees}
     if "editing_index" not in st.session_state:
         st.session_state.editing_index = None
+    if "built" not in st.session_state:
+        st.session_state.built = None
 
 def get_employee_by_name(name: str):
-    for e in st.session_state.employees:
-        if e["name"] == name:
-            return e
-    return None
+    return st.session_state.employees_by_name.get(name)
 
 def ensure_employee(name: str, rate_pct=25.0, truck=False, meter=False):
     if not name.strip():
         return
     e = get_employee_by_name(name.strip())
     if e is None:
-        st.session_state.employees.append({
+        e = {
             "name": name.strip(),
             "rate_pct": float(rate_pct),
             "truck": bool(truck),
             "meter": bool(meter),
-        })
-
-def auto_col_width(ws):
-    for col in ws.columns:
-        max_len = 0
-        col_letter = col[0].column_letter
-        for cell in col:
-            v = "" if cell.value is None else str(cell.value)
-            max_len = max(max_len, len(v))
-        ws.column_dimensions[col_letter].width = min(max(10, max_len + 2), 60)
-
-def format_amount_col(ws, amount_col_idx: int, bold_rows: set):
-    for col_cells in ws.iter_cols(min_col=amount_col_idx, max_col=amount_col_idx, min_row=2, max_row=ws.max_row):
-        for c in col_cells:
-            c.alignment = Alignment(horizontal="right")
-            if isinstance(c.value, (int, float)):
-                c.number_format = numbers.FORMAT_CURRENCY_USD_SIMPLE
-            if c.row in bold_rows:
-                c.font = Font(bold=True)
-
-def export_per_tech_xlsx(df_tech: pd.DataFrame, tech_info: dict, date_col: str, tech_col: str, jobfee_col: str) -> bytes:
-    """
-    - Amount = Job Fee * (Rate% / 100)
-    - Truck ($50/day, cap $150), Meter ($25), Penguin ($6.25)
-    - Charge names in far-left column, amounts in last column
-    - Bold Total row; auto-size columns
-    """
-    d = df_tech.copy()
-    d["Rate (%)"] = float(tech_info["rate_pct"])
-    base = pd.to_numeric(d[jobfee_col], errors="coerce").fillna(0.0)
-    d["Amount"] = base * (d["Rate (%)"] / 100.0)
+        }
+        st.session_state.employees.append(e)
+        st.session_state.employees_by_name[e["name"]] = e
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = tech_info["name"][:31]
-
-    cols = list(d.columns)
+def read_xlsx(data: bytes, **kwargs) -> pd.DataFrame:
+    # The Rust-based calamine reader is several times faster than openpyxl; use it when
+    # python-calamine is installed (older pandas without the engine raise ValueError)
+    try:
+        return pd.read_excel(io.BytesIO(data), engine="calamine", **kwargs)
+    except (ImportError, ValueError):
+        return pd.read_excel(io.BytesIO(data), **kwargs)
+
+# The parsed frames and built ZIPs are the large cache entries; cap how many are kept in memory
+MAX_CACHED_REPORTS = 8
+
+@st.cache_data(show_spinner=False, max_entries=MAX_CACHED_REPORTS)
+def load_report(data: bytes) -> pd.DataFrame:
+    # Keyed on the file contents, so reruns of the same upload skip the xlsx parse
+    return read_xlsx(data)
+
+@st.cache_data(show_spinner=False)
+def load_preview(data: bytes, nrows: int = 20) -> pd.DataFrame:
+    # Header and first rows only: enough for the preview and column mapping. Always openpyxl:
+    # its read-only reader stops parsing after `nrows`, whereas calamine loads the whole sheet
+    return pd.read_excel(io.BytesIO(data), engine="openpyxl", nrows=nrows)
+
+@st.cache_data(show_spinner=False)
+def unique_techs(data: bytes, tech_col: str) -> list:
+    # Keyed on the upload bytes (a cheap digest) rather than on a parsed frame, which Streamlit
+    # would have to hash column by column on every call
+    df = load_report(data)
+    return sorted(df[tech_col].dropna().astype(str).unique())
+
+@st.cache_data(show_spinner=False)
+def match_techs(system_names: tuple, techs_in_file: tuple) -> list:
+    system_set = set(system_names)
+    return [t for t in techs_in_file if t in system_set]
+
+def col_width(header, values, extra=()) -> float:
+    # Write-only sheets can't be read back, so columns are sized from the source values before
+    # rows are streamed. Only one column is converted to str at a time (and empty columns are fine).
+    col = pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(col):
+        longest = 19  # openpyxl shows datetimes as yyyy-mm-dd h:mm:ss; skip formatting every value
+    else:
+        longest = col.astype(str).str.len().max()
+    max_len = max(len(str(header)), 0 if pd.isna(longest) else int(longest))
+    for v in extra:
+        if v is not None:
+            max_len = max(max_len, len(str(v)))
+    return min(max(10, max_len + 2), 60)
+
+def auto_col_width(ws, widths: list):
+    for i, w in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(i)].width = w
+
+# One scratch buffer per thread (Streamlit runs each session on its own), see save_to_bytes()
+_BUF = threading.local()
+
+def save_to_bytes(wb: Workbook) -> bytes:
+    # Overwrite the thread's buffer from the start instead of allocating and regrowing a fresh
+    # BytesIO per workbook (truncate(0) would release the allocation). ZipFile in "w" mode
+    # doesn't truncate, so only the bytes up to the end of this save are returned.
+    bio = getattr(_BUF, "bio", None)
+    if bio is None:
+        bio = _BUF.bio = io.BytesIO()
+    bio.seek(0)
+    wb.save(bio)
+    with bio.getbuffer() as view:
+        return bytes(view[:bio.tell()])
+
+def money_cell(ws, value, bold: bool = False) -> WriteOnlyCell:
+    c = WriteOnlyCell(ws, value=value)
+    c.alignment = RIGHT
+    c.number_format = numbers.FORMAT_CURRENCY_USD_SIMPLE
+    if bold:
+        c.font = BOLD
+    return c
+
+# Report-wide dates parsed once before exporting so techs don't each re-parse the date column.
+# Normalized to midnight but kept as datetime64, so counting days never boxes per-row date objects.
+DATE_NORM_COL = "_date_norm"
+# Job fee coerced to float once per report in the same way
+JOBFEE_NUM_COL = "_jobfee_num"
+
+# Labels written in the first column below the data rows
+CHARGE_LABELS = ("Truck Charge", "Meter Fee", "Penguin Data Fee", "Total:")
+
+def order_columns(cols: list, date_col: str, tech_col: str) -> list:
+    """Output column order: date, technician, the rest of the report, then Rate (%) and Amount."""
     ordered = []
     if date_col in cols: ordered.append(date_col)
     if tech_col in cols and tech_col not in ordered: ordered.append(tech_col)
     for c in cols:
-        if c not in {date_col, tech_col, "Rate (%)", "Amount"}:
+        if c not in {date_col, tech_col, DATE_NORM_COL, JOBFEE_NUM_COL, "Rate (%)", "Amount"}:
             ordered.append(c)
     ordered.extend(["Rate (%)", "Amount"])
-    d = d[ordered]
-
-    for r in dataframe_to_rows(d, index=False, header=True):
-        ws.append(r)
-
-    last_col_idx = ws.max_column
-    amount_col_idx = last_col_idx
+    return ordered
 
-    bold_rows = set()
-    charges_total = 0.0
+def sheet_layout(df: pd.DataFrame, date_col: str, tech_col: str) -> dict:
+    """
+    The parts of a tech sheet that only depend on the report, built once and shared by every export:
+    - column order (see order_columns) and the None padding of charge/total rows
+    - widths of the report columns, sized over the whole report so every tech file lines up
+    """
+    ordered = order_columns(list(df.columns), date_col, tech_col)
+    src_cols = ordered[:-2]
+    widths = [col_width(c, df[c], CHARGE_LABELS if i == 0 else ()) for i, c in enumerate(src_cols)]
+    return {"ordered": ordered, "pad": (None,) * (len(ordered) - 2), "widths": widths}
+
+def sheet_titles(names: list) -> list:
+    """Excel sheet titles for `names`: at most 31 characters and unique (case-insensitively) within a workbook."""
+    titles, seen = [], set()
+    for name in names:
+        title, n = name[:31], 1
+        while title.lower() in seen:
+            suffix = f" ({n})"
+            title = name[:31 - len(suffix)] + suffix
+            n += 1
+        seen.add(title.lower())
+        titles.append(title)
+    return titles
+
+def write_tech_sheet(wb: Workbook, df_tech: pd.DataFrame, tech_info: dict, date_col: str, tech_col: str,
+                     jobfee_col: str, layout: dict = None, title: str = None):
+    """
+    Add one tech's sheet to a write-only workbook:
+    - Amount = Job Fee * (Rate% / 100)
+    - Truck ($50/day, cap $150), Meter ($25), Penguin ($6.25)
+    - Charge names in far-left column, amounts in last column
+    - Bold Total row; auto-size columns
+    - Rows are streamed through a write-only workbook, so nothing is read back from the sheet
+    - `layout` comes from sheet_layout(); pass it in to build it once per report
+    - `title` defaults to the tech's name cut to Excel's 31-character limit
+    """
+    # Rate (%) and Amount are kept beside the report columns instead of copying df_tech to add them
+    rate = float(tech_info["rate_pct"])
+    if JOBFEE_NUM_COL in df_tech.columns:
+        base = df_tech[JOBFEE_NUM_COL].to_numpy()
+    else:
+        base = pd.to_numeric(df_tech[jobfee_col], errors="coerce").fillna(0.0).to_numpy()
+    amount = base * (rate / 100.0)
+    data_amount_sum = float(amount.sum())
+
+    if layout is None:
+        layout = sheet_layout(df_tech, date_col, tech_col)
+    ordered, pad = layout["ordered"], layout["pad"]
+    src_cols = ordered[:-2]
+    charges = []
 
     if tech_info.get("truck"):
-        unique_days = pd.to_datetime(d[date_col], errors="coerce").dt.date.dropna().unique()
-        truck_fee = min(3, len(unique_days)) * 50.0
+        if DATE_NORM_COL in df_tech.columns:
+            days = df_tech[DATE_NORM_COL]
+        else:
+            days = pd.to_datetime(df_tech[date_col], errors="coerce").dt.normalize()
+        truck_fee = min(3, days.nunique()) * 50.0
         if truck_fee > 0:
-            ws.append(["Truck Charge"] + [None]*(last_col_idx - 2) + [truck_fee])
-            charges_total += truck_fee
+            charges.append(("Truck Charge", *pad, truck_fee))
 
     if tech_info.get("meter"):
-        ws.append(["Meter Fee"] + [None]*(last_col_idx - 2) + [25.0])
-        charges_total += 25.0
-
-    ws.append(["Penguin Data Fee"] + [None]*(last_col_idx - 2) + [6.25])
-    charges_total += 6.25
-
-    data_end_row = 1 + len(d)
-    data_amount_sum = 0.0
-    for r in range(2, data_end_row + 1):
-        val = ws.cell(row=r, column=amount_col_idx).value
-        if isinstance(val, (int, float)):
-            data_amount_sum += float(val)
-
-    total = data_amount_sum + charges_total
-    ws.append(["Total:"] + [None]*(last_col_idx - 2) + [total])
-    total_row_idx = ws.max_row
-
-    for cell in ws[1]:
-        cell.font = Font(bold=True)
-        cell.alignment = Alignment(vertical="center")
-    for cell in ws[total_row_idx]:
-        cell.font = Font(bold=True)
-
-    bold_rows.add(total_row_idx)
-    format_amount_col(ws, amount_col_idx, bold_rows)
-    auto_col_width(ws)
-
-    bio = io.BytesIO()
-    wb.save(bio)
-    return bio.getvalue()
+        charges.append(("Meter Fee", *pad, 25.0))
+
+    charges.append(("Penguin Data Fee", *pad, 6.25))
+
+    total = data_amount_sum + sum(r[-1] for r in charges)
+
+    ws = wb.create_sheet(title=title or tech_info["name"][:31])
+    auto_col_width(ws, layout["widths"] + [
+        col_width("Rate (%)", [rate]),
+        col_width("Amount", amount, [r[-1] for r in charges] + [total]),
+    ])
+
+    header = []
+    for c in ordered:
+        cell = WriteOnlyCell(ws, value=c)
+        cell.font = BOLD
+        cell.alignment = HDR_ALIGN
+        header.append(cell)
+
+    label = WriteOnlyCell(ws, value="Total:")
+    label.font = BOLD
+
+    # append() serializes the row straight away, so one styled cell can carry every Amount
+    # and the currency style is resolved once for the whole column
+    amount_cell = money_cell(ws, None)
+
+    def sheet_rows():
+        yield header
+        # Zipping the columns directly (what itertuples does internally) avoids building a
+        # reordered sub-frame of df_tech just to iterate it
+        for r in zip(*(df_tech[c] for c in src_cols), amount.tolist()):
+            amount_cell.value = r[-1]
+            yield r[:-1] + (rate, amount_cell)
+        for r in charges:
+            amount_cell.value = r[-1]
+            yield r[:-1] + (amount_cell,)
+        yield (label, *pad, money_cell(ws, total, bold=True))
+
+    for r in sheet_rows():
+        ws.append(r)
+
+def export_per_tech_xlsx(df_tech: pd.DataFrame, tech_info: dict, date_col: str, tech_col: str, jobfee_col: str,
+                        layout: dict = None) -> bytes:
+    """One tech's sheet (see write_tech_sheet) saved as its own workbook."""
+    wb = Workbook(write_only=True)
+    write_tech_sheet(wb, df_tech, tech_info, date_col, tech_col, jobfee_col, layout)
+    return save_to_bytes(wb)
+
+def tech_jobs(file_bytes: bytes, date_col: str, tech_col: str, jobfee_col: str, emps_json: str):
+    """
+    Everything the exports need from the report, prepared once: returns (jobs, layout), where
+    jobs maps each matched tech to (their rows, their settings) and layout is the shared sheet_layout().
+    """
+    df = load_report(file_bytes)
+    employees = {e["name"]: e for e in json.loads(emps_json)}
+    matched = match_techs(tuple(employees), tuple(unique_techs(file_bytes, tech_col)))
+
+    # Partition the report by technician once (cast to str and grouped a single time)
+    # instead of re-scanning it for every match
+    tech_names = df[tech_col].astype(str)
+    tech_positions = tech_names.groupby(tech_names, sort=False).indices
+
+    df[DATE_NORM_COL] = pd.to_datetime(df[date_col], errors="coerce").dt.normalize()
+    df[JOBFEE_NUM_COL] = pd.to_numeric(df[jobfee_col], errors="coerce").fillna(0.0)
+
+    jobs = {t: (df.iloc[tech_positions[t]], employees[t]) for t in matched if t in tech_positions}
+    return jobs, sheet_layout(df, date_col, tech_col)
+
+@st.cache_data(show_spinner="Building reports...", max_entries=MAX_CACHED_REPORTS)
+def build_zip(file_bytes: bytes, date_col: str, tech_col: str, jobfee_col: str, emps_json: str, report_date: str):
+    """
+    Per-tech workbooks for the matched technicians, zipped: returns (zip bytes, file count).
+    Cached on the upload, the column mapping, a JSON snapshot of the technicians and the date in
+    the file names, so reruns that change none of these skip the whole export.
+    """
+    jobs, layout = tech_jobs(file_bytes, date_col, tech_col, jobfee_col, emps_json)
+
+    # .xlsx files are already deflated internally, so they are stored rather than recompressed
+    zbuf = io.BytesIO()
+    with zipfile.ZipFile(zbuf, mode="w", compression=zipfile.ZIP_STORED) as z:
+        export_count = 0
+        for t, (tech_rows, info) in jobs.items():
+            fname = f"{t.replace(' ', '_')}_{report_date}.xlsx"
+            z.writestr(fname, export_per_tech_xlsx(tech_rows, info, date_col, tech_col, jobfee_col, layout))
+            export_count += 1
+
+    return zbuf.getvalue(), export_count
+
+@st.cache_data(show_spinner="Building workbook...", max_entries=MAX_CACHED_REPORTS)
+def build_workbook(file_bytes: bytes, date_col: str, tech_col: str, jobfee_col: str, emps_json: str):
+    """
+    All matched technicians as sheets of a single workbook: returns (xlsx bytes, sheet count).
+    Styles, shared strings and the other package parts are written once rather than once per tech.
+    Cached like build_zip().
+    """
+    jobs, layout = tech_jobs(file_bytes, date_col, tech_col, jobfee_col, emps_json)
+    wb = Workbook(write_only=True)
+    # openpyxl de-duplicates clashing titles by appending digits, which can push them past 31 characters
+    titles = sheet_titles([info["name"] for _, info in jobs.values()])
+    for (tech_rows, info), title in zip(jobs.values(), titles):
+        write_tech_sheet(wb, tech_rows, info, date_col, tech_col, jobfee_col, layout, title)
+    return save_to_bytes(wb), len(jobs)
 
 # ---------- UI ----------
 init_state()
@@ -225,16 +404,17 @@ with st.sidebar:
 uploaded = st.file_uploader("Upload weekly .xlsx report", type=["xlsx"])
 
 if uploaded:
+    data = uploaded.getvalue()
     try:
-        df = pd.read_excel(uploaded)
+        preview = load_preview(data)
     except Exception as e:
         st.error(f"Could not read Excel: {e}")
         st.stop()
 
     st.subheader("Preview")
-    st.dataframe(df.head(20), use_container_width=True)
+    st.dataframe(preview, use_container_width=True)
 
-    cols = list(df.columns)
+    cols = list(preview.columns)
     if len(cols) < 3:
         st.error("The report should have at least three columns (Date, Technician, Job Fee).")
         st.stop()
@@ -245,46 +425,76 @@ if uploaded:
     default_jobfee = cols[-1]
 
     st.markdown("#### Column mapping")
-    c1, c2, c3 = st.columns(3)
-    with c1:
-        date_col = st.selectbox("Date column", cols, index=cols.index(default_date))
-    with c2:
-        tech_col = st.selectbox("Technician column", cols, index=cols.index(guess_tech))
-    with c3:
-        jobfee_col = st.selectbox("Job fee column (multiplied by Rate %)", cols, index=cols.index(default_jobfee))
-
-    # Match technicians from file to our prepop list
-    techs_in_file = sorted(df[tech_col].dropna().astype(str).unique())
-    system_names = [e["name"] for e in st.session_state.employees]
-    matched = [t for t in techs_in_file if t in system_names]
-
-    if not matched:
-        st.warning("No matching technicians between the file and the system list. Adjust names in the sidebar or the mapping.")
-        st.stop()
-
-    st.markdown("#### Technicians detected & matched")
-    st.write(", ".join(matched))
-
-    # Create ZIP of per-tech files
-    zbuf = io.BytesIO()
-    with zipfile.ZipFile(zbuf, mode="w", compression=zipfile.ZIP_DEFLATED) as z:
-        export_count = 0
-        for t in matched:
-            tech_rows = df[df[tech_col].astype(str) == t]
-            if tech_rows.empty:
-                continue
-            info = get_employee_by_name(t)
-            out_bytes = export_per_tech_xlsx(tech_rows, info, date_col, tech_col, jobfee_col)
-            fname = f"{t.replace(' ', '_')}_{datetime.now().date()}.xlsx"
-            z.writestr(fname, out_bytes)
-            export_count += 1
-
-    st.success(f"Prepared {export_count} file(s).")
-    st.download_button(
-        "Download ZIP with technician files",
-        data=zbuf.getvalue(),
-        file_name=f"technician_breakdowns_{datetime.now().date()}.zip",
-        mime="application/zip",
-    )
+    # A form, so changing a dropdown doesn't rerun the export; it only runs on "Build reports"
+    with st.form("mapping"):
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            date_col = st.selectbox("Date column", cols, index=cols.index(default_date))
+        with c2:
+            tech_col = st.selectbox("Technician column", cols, index=cols.index(guess_tech))
+        with c3:
+            jobfee_col = st.selectbox("Job fee column (multiplied by Rate %)", cols, index=cols.index(default_jobfee))
+        single_workbook = st.checkbox("Single workbook with one sheet per tech")
+        submitted = st.form_submit_button("Build reports")
+
+    if submitted:
+        # Match technicians from file to our prepop list
+        try:
+            techs_in_file = unique_techs(data, tech_col)
+        except Exception as e:
+            st.error(f"Could not read Excel: {e}")
+            st.stop()
+        system_names = tuple(st.session_state.employees_by_name)
+        matched = match_techs(system_names, tuple(techs_in_file))
+
+        if not matched:
+            st.session_state.built = None
+            st.warning("No matching technicians between the file and the system list. Adjust names in the sidebar or the mapping.")
+            st.stop()
+
+        emps_json = json.dumps(st.session_state.employees, sort_keys=True)
+        today = datetime.now().date()
+        if single_workbook:
+            out_bytes, sheet_count = build_workbook(data, date_col, tech_col, jobfee_col, emps_json)
+            download = {
+                "summary": f"Prepared 1 workbook with {sheet_count} sheet(s).",
+                "label": "Download workbook with technician sheets",
+                "file_name": f"technician_breakdowns_{today}.xlsx",
+                "mime": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            }
+        else:
+            out_bytes, export_count = build_zip(data, date_col, tech_col, jobfee_col, emps_json, str(today))
+            download = {
+                "summary": f"Prepared {export_count} file(s).",
+                "label": "Download ZIP with technician files",
+                "file_name": f"technician_breakdowns_{today}.zip",
+                "mime": "application/zip",
+            }
+        # Kept in session state so the download survives the reruns that follow, along with
+        # the upload and technician settings it was built from so later sidebar edits can be detected
+        st.session_state.built = {
+            "file_id": uploaded.file_id,
+            "emps_json": emps_json,
+            "matched": matched,
+            "data": out_bytes,
+            **download,
+        }
+
+    built = st.session_state.built
+    if built and built["file_id"] != uploaded.file_id:
+        built = None
+    if built and built["emps_json"] != json.dumps(st.session_state.employees, sort_keys=True):
+        st.info("Technician settings changed — click Build reports to update the files.")
+    elif built:
+        st.markdown("#### Technicians detected & matched")
+        st.write(", ".join(built["matched"]))
+
+        st.success(built["summary"])
+        st.download_button(
+            built["label"],
+            data=built["data"],
+            file_name=built["file_name"],
+            mime=built["mime"],
+        )
 else:
     st.info("Upload a weekly .xlsx report to begin.")